@@ -1,11 +1,16 @@
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import gradio as gr
 from typing import Iterator, List, Dict, Tuple
 from datetime import datetime
+from functools import partial
+from itertools import accumulate, islice
+from bisect import bisect_right
+import heapq
 import os
+import mmap
 import tiktoken
-import glob
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -17,38 +22,43 @@ encoding = tiktoken.get_encoding("cl100k_base")
 # 配置常量
 MAX_TOKENS = 4000
 MAX_HISTORY_ITEMS = 20
+TOKEN_CACHE_SIZE = 8192
+TOKENIZER_THREADS = 4
+TOKENIZER_BATCH_MIN = 16  # 未缓存文本达到该数量时才使用批量编码
+MAX_TURNS_PER_FILE = 50  # 单个对话文件最多保存的轮数，超出后写入新文件
+MAX_CONVERSATION_FILES = 100  # 最多保留的对话文件数，超出后删除最旧的文件
+CHARS_PER_TOKEN_ESTIMATE = 4  # 经验值（cl100k平均约1-4个字符/token），仅用于估算每批tokenize的记录数
 CONVERSATION_DIR = os.path.join("data", "conversations")
 TRAINING_DATA_DIR = os.path.join("data", "training_data")
 
+# 复用HTTP连接，避免每次请求重新进行TLS握手
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
 # 确保数据目录存在
 os.makedirs(CONVERSATION_DIR, exist_ok=True)
 os.makedirs(TRAINING_DATA_DIR, exist_ok=True)
 
 def convert_to_openai_format(chat_history: List[Tuple[str, str]]) -> List[Dict]:
     """将对话历史转换为OpenAI格式"""
-    formatted = []
-    for item in chat_history:
-        if len(item) == 2:  # 确保是(user_msg, bot_msg)格式
-            user_msg, bot_msg = item
-            formatted.append({"role": "user", "content": user_msg})
-            formatted.append({"role": "assistant", "content": bot_msg})
-    return formatted
+    return [
+        message
+        for item in chat_history
+        if len(item) == 2  # 确保是(user_msg, bot_msg)格式
+        for message in ({"role": "user", "content": item[0]}, {"role": "assistant", "content": item[1]})
+    ]
 
 def convert_from_openai_format(formatted_history: List[Dict]) -> List[Tuple[str, str]]:
     """从OpenAI格式转换回元组格式"""
-    chat_history = []
-    for i in range(0, len(formatted_history), 2):
-        if i+1 < len(formatted_history):
-            user_msg = formatted_history[i]["content"]
-            bot_msg = formatted_history[i+1]["content"]
-            chat_history.append((user_msg, bot_msg))
-    return chat_history
+    messages = iter(formatted_history)
+    # zip同一迭代器两次，按(user, assistant)两两配对，末尾不成对的消息被丢弃
+    return [(user_msg["content"], bot_msg["content"]) for user_msg, bot_msg in zip(messages, messages)]
 
 def load_profile():
     """加载用户配置文件"""
     try:
-        with open('profile.json', 'r', encoding='utf-8') as f:
-            profile = json.load(f)
+        with open('profile.json', 'rb') as f:
+            profile = orjson.loads(f.read())
             return profile['my_profile']
     except FileNotFoundError:
         print("错误: profile.json 文件未找到")
@@ -61,111 +71,252 @@ def load_profile():
                 "memory": []
             }
         }
-        with open('profile.json', 'w', encoding='utf-8') as f:
-            json.dump(default_profile, f, ensure_ascii=False, indent=2)
+        with open('profile.json', 'wb') as f:
+            f.write(orjson.dumps(default_profile, option=orjson.OPT_INDENT_2))
         return default_profile['my_profile']
     except Exception as e:
         print(f"加载配置文件错误: {str(e)}")
         return None
 
+# token计数缓存（LRU），历史消息只编码一次
+_token_cache: Dict[str, int] = {}
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    """批量计算token数，未缓存的文本较多时通过一次encode_ordinary_batch调用完成编码"""
+    known = {}
+    for text in texts:
+        if text in known:
+            continue
+        count = _token_cache.pop(text, None)
+        if count is not None:
+            _token_cache[text] = count  # 命中后移到末尾，淘汰时按最近使用顺序
+        known[text] = count
+    missing = [t for t, count in known.items() if count is None]
+    if len(missing) >= TOKENIZER_BATCH_MIN:
+        encoded = encoding.encode_ordinary_batch(missing, num_threads=TOKENIZER_THREADS)
+    else:  # 少量文本直接编码，避免批量接口每次创建线程池的开销
+        encoded = [encoding.encode_ordinary(text) for text in missing]
+    for text, tokens in zip(missing, encoded):
+        known[text] = _token_cache[text] = len(tokens)
+    # 超出上限时淘汰最久未使用的缓存项（可能被并发调用，删除时容忍已被移除的键）
+    overflow = len(_token_cache) - TOKEN_CACHE_SIZE
+    if overflow > 0:
+        for text in list(islice(_token_cache, overflow)):
+            _token_cache.pop(text, None)
+    return [known[t] for t in texts]
+
 def count_tokens(text: str) -> int:
-    return len(encoding.encode(text))
+    return count_tokens_batch([text])[0]
+
+def count_item_tokens(conversation: List[Tuple[str, str]]) -> List[int]:
+    """计算每轮(user_msg, bot_msg)的token数"""
+    counts = count_tokens_batch([msg for item in conversation for msg in item])
+    return [counts[i] + counts[i + 1] for i in range(0, len(counts), 2)]
 
 def trim_conversation(conversation: List[Tuple[str, str]], max_tokens: int) -> List[Tuple[str, str]]:
+    conversation = [item for item in conversation if len(item) == 2]  # 跳过格式不正确的条目
     total_tokens = 0
-    trimmed = []
+    start = len(conversation)
     
-    for item in reversed(conversation):
-        if len(item) != 2:  # 跳过格式不正确的条目
-            continue
-            
-        user_msg, bot_msg = item
-        item_tokens = count_tokens(user_msg) + count_tokens(bot_msg)
+    while start > 0:
+        # 按字符数估算剩余预算大约能容纳的轮数，只对这一批较新的记录进行tokenize
+        max_chars = (max_tokens - total_tokens) * CHARS_PER_TOKEN_ESTIMATE
+        batch_start = start
+        batch_chars = 0
+        while batch_start > 0 and batch_chars <= max_chars:
+            batch_start -= 1
+            user_msg, bot_msg = conversation[batch_start]
+            batch_chars += len(user_msg) + len(bot_msg)
         
-        if total_tokens + item_tokens > max_tokens:
+        # 从最新一轮开始累加token数，二分查找本批可保留的轮数
+        counts = count_item_tokens(conversation[batch_start:start])
+        token_totals = list(accumulate(reversed(counts), initial=total_tokens))
+        keep = bisect_right(token_totals, max_tokens) - 1
+        start -= keep
+        if keep < len(counts):  # 精确计数已超出预算，更早的记录无需再tokenize
             break
-            
-        trimmed.insert(0, item)
-        total_tokens += item_tokens
+        total_tokens = token_totals[-1]
     
-    return trimmed
+    return conversation[start:]
+
+# 对话文件缓存: {文件路径: (修改时间, 对话内容)}
+_conv_cache: Dict[str, Tuple[float, List[Tuple[str, str]]]] = {}
+# 最近对话合并结果缓存: ((token预算, 文件及修改时间列表), 合并后的对话)
+_recent_cache: Tuple[Tuple[int, Tuple[Tuple[str, float], ...]], List[Tuple[str, str]]] = ((0, ()), [])
+
+# 对话文件索引: {文件路径: 修改时间}，首次使用时扫描目录，之后在写入时更新
+_conv_index: Dict[str, float] = {}
+_conv_index_loaded = False
+
+def _is_conversation_file(name: str) -> bool:
+    return name.startswith("conversation_") and name.endswith((".json", ".jsonl"))
 
-def save_conversation(conversation: List[Tuple[str, str]], filename: str = None) -> str:
-    """保存对话到文件"""
+def _load_conversation_index() -> Dict[str, float]:
+    """单次scandir扫描对话目录，DirEntry.stat()复用目录项缓存"""
+    global _conv_index_loaded
+    if not _conv_index_loaded:
+        with os.scandir(CONVERSATION_DIR) as entries:
+            for entry in entries:
+                if entry.is_file() and _is_conversation_file(entry.name):
+                    _conv_index[entry.path] = entry.stat().st_mtime
+        _conv_index_loaded = True
+    return _conv_index
+
+# 各对话文件已写入的轮数
+_file_turns: Dict[str, int] = {}
+
+def _prune_conversation_dir(max_files: int = MAX_CONVERSATION_FILES):
+    """删除超出数量上限的最旧对话文件"""
+    index = _load_conversation_index()
+    overflow = len(index) - max_files
+    if overflow <= 0:
+        return
+    for file in heapq.nsmallest(overflow, index, key=index.get):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"删除对话文件 {file} 失败: {str(e)}")
+            continue
+        index.pop(file, None)
+        _conv_cache.pop(file, None)
+        _file_turns.pop(file, None)
+
+def append_turn(user_msg: str, bot_msg: str, filename: str = None) -> str:
+    """以JSONL格式追加一轮对话到文件，每条消息一行；文件达到MAX_TURNS_PER_FILE轮后换用新文件"""
+    if filename and filename not in _file_turns:
+        _file_turns[filename] = len(load_conversation(filename)) if os.path.exists(filename) else 0
+    if filename and _file_turns[filename] >= MAX_TURNS_PER_FILE:
+        filename = None
+    
     if not filename:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = os.path.join(CONVERSATION_DIR, f"conversation_{timestamp}.json")
+        filename = os.path.join(CONVERSATION_DIR, f"conversation_{timestamp}.jsonl")
+        suffix = 1
+        while os.path.exists(filename):  # 同一秒内换用新文件时避免重名
+            filename = os.path.join(CONVERSATION_DIR, f"conversation_{timestamp}_{suffix}.jsonl")
+            suffix += 1
     
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(convert_to_openai_format(conversation), f, ensure_ascii=False, indent=2)
+        with open(filename, 'ab') as f:
+            f.write(
+                orjson.dumps({"role": "user", "content": user_msg}, option=orjson.OPT_APPEND_NEWLINE)
+                + orjson.dumps({"role": "assistant", "content": bot_msg}, option=orjson.OPT_APPEND_NEWLINE)
+            )
+        _file_turns[filename] = _file_turns.get(filename, 0) + 1
+        index = _load_conversation_index()
+        is_new_file = filename not in index
+        index[filename] = os.path.getmtime(filename)
+        if is_new_file:
+            _prune_conversation_dir()
         return filename
     except Exception as e:
         print(f"保存对话失败: {str(e)}")
         return ""
 
 def load_conversation(filename: str) -> List[Tuple[str, str]]:
-    """从文件加载对话"""
+    """从文件加载对话，文件未修改时直接返回缓存"""
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            formatted_history = json.load(f)
-            return convert_from_openai_format(formatted_history)
+        mtime = os.path.getmtime(filename)
+        cached = _conv_cache.get(filename)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(filename, 'rb') as f:
+            if filename.endswith(".jsonl"):
+                formatted_history = []
+                if os.fstat(f.fileno()).st_size:  # 空文件无法mmap
+                    # mmap映射文件后逐行解析，避免将整个文件复制到内存
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        formatted_history = [orjson.loads(line) for line in iter(mm.readline, b"") if line.strip()]
+            else:  # 兼容旧版整体保存的JSON文件
+                formatted_history = orjson.loads(f.read())
+            conversation = convert_from_openai_format(formatted_history)
+        _conv_cache[filename] = (mtime, conversation)
+        return conversation
     except Exception as e:
         print(f"加载对话失败: {str(e)}")
         return []
 
-def get_conversation_files() -> List[str]:
-    """获取所有对话文件，按时间排序"""
-    files = glob.glob(os.path.join(CONVERSATION_DIR, "conversation_*.json"))
-    return sorted(files, key=os.path.getmtime, reverse=True)
+def get_conversation_files(max_count: int = None) -> List[str]:
+    """获取对话文件，按时间从新到旧排序；指定max_count时只选取最新的max_count个"""
+    index = _load_conversation_index()
+    if max_count is None:
+        return sorted(index, key=index.get, reverse=True)
+    return heapq.nlargest(max_count, index, key=index.get)
 
-def load_recent_conversations(max_count=30) -> List[Tuple[str, str]]:
-    """加载最近的对话记录"""
-    conversation_files = get_conversation_files()
-    recent_conversations = []
+def load_recent_conversations(max_count=30, max_tokens=MAX_TOKENS // 2) -> List[Tuple[str, str]]:
+    """从新到旧加载最近max_count个对话文件，token数超出max_tokens后不再读取更早的文件"""
+    global _recent_cache
+    conversation_files = get_conversation_files(max_count)
+    key = (max_tokens, tuple((file, _conv_index[file]) for file in conversation_files))
+    if key == _recent_cache[0]:
+        return list(_recent_cache[1])
     
-    for file in conversation_files[:max_count]:
+    loaded = []
+    tokens_used = 0
+    
+    for file in conversation_files:
         try:
             conversation = load_conversation(file)
-            recent_conversations.extend(conversation)
+            loaded.append(conversation)
+            # token数会被缓存，随后trim_conversation裁剪时直接复用
+            tokens_used += sum(count_item_tokens(conversation))
         except Exception as e:
             print(f"加载对话文件 {file} 失败: {str(e)}")
+        if tokens_used > max_tokens:
+            break
     
-    return recent_conversations[-max_count:]
+    # 文件按从新到旧读取，合并时恢复时间顺序
+    recent_conversations = [item for conversation in reversed(loaded) for item in conversation]
+    _recent_cache = (key, recent_conversations)
+    return list(recent_conversations)
 
-def prepare_api_messages(conversation: List[Tuple[str, str]], profile: dict, new_message: str) -> List[Dict]:
-    system_prompt = {
-        "role": "system",
-        "content": f"""你正在与{profile['name']}对话:
+def build_system_prompt(profile: dict) -> str:
+    """根据用户配置生成系统提示词"""
+    return f"""你正在与{profile['name']}对话:
         年龄: {profile['age']}
         职业: {profile['profession']}
         兴趣: {', '.join(profile['interests'])}"""
-    }
+
+def prepare_api_messages(conversation: List[Tuple[str, str]], system_prompt: str, system_prompt_tokens: int, new_message: str) -> Tuple[List[Dict], int]:
+    """构建API消息列表，返回(消息列表, 已使用的token数)"""
+    messages = [{"role": "system", "content": system_prompt}]
+    tokens_used = system_prompt_tokens
     
-    messages = [system_prompt]
-    tokens_used = count_tokens(system_prompt["content"])
+    history = [item for item in conversation[-MAX_HISTORY_ITEMS:] if len(item) == 2]  # 跳过格式不正确的条目
     
-    for item in conversation[-MAX_HISTORY_ITEMS:]:
-        if len(item) != 2:  # 跳过格式不正确的条目
-            continue
-            
-        user_msg, bot_msg = item
-        user_content = {"role": "user", "content": user_msg}
-        bot_content = {"role": "assistant", "content": bot_msg}
-        
-        new_tokens = count_tokens(user_msg) + count_tokens(bot_msg)
-        if tokens_used + new_tokens > MAX_TOKENS:
-            break
-            
-        messages.extend([user_content, bot_content])
-        tokens_used += new_tokens
+    # 按时间顺序累加token数，二分查找不超过MAX_TOKENS的最长前缀
+    token_totals = list(accumulate(count_item_tokens(history), initial=tokens_used))
+    keep = max(bisect_right(token_totals, MAX_TOKENS) - 1, 0)
+    messages.extend(convert_to_openai_format(history[:keep]))
+    tokens_used = token_totals[keep]
     
-    if count_tokens(new_message) + tokens_used < MAX_TOKENS:
+    new_message_tokens = count_tokens(new_message)
+    if new_message_tokens + tokens_used < MAX_TOKENS:
         messages.append({"role": "user", "content": new_message})
+        tokens_used += new_message_tokens
     
-    return messages
+    return messages, tokens_used
 
-def call_deepseek_api_stream(prompt: str, conversation: List[Tuple[str, str]], profile: dict) -> Iterator[str]:
+def iter_sse_data(response: requests.Response) -> Iterator[bytes]:
+    """按字节解析SSE流，只返回data:行的负载，不做逐行解码"""
+    buffer = bytearray()
+    for block in response.iter_content(chunk_size=None):
+        buffer += block
+        start = 0
+        end = buffer.find(b"\n")
+        while end != -1:
+            line = buffer[start:end]
+            if line.startswith(b"data:"):
+                yield bytes(line[5:].strip())
+            start = end + 1
+            end = buffer.find(b"\n", start)
+        del buffer[:start]
+    if buffer.startswith(b"data:"):
+        yield bytes(buffer[5:].strip())
+
+def call_deepseek_api_stream(prompt: str, conversation: List[Tuple[str, str]], system_prompt: str, system_prompt_tokens: int) -> Iterator[str]:
     api_url = "https://api.deepseek.com/v1/chat/completions"
     api_key = os.getenv("DEEPSEEK_API_KEY")
     
@@ -178,38 +329,34 @@ def call_deepseek_api_stream(prompt: str, conversation: List[Tuple[str, str]], p
         "Content-Type": "application/json"
     }
     
-    messages = prepare_api_messages(conversation, profile, prompt)
+    messages, tokens_used = prepare_api_messages(conversation, system_prompt, system_prompt_tokens, prompt)
     
     data = {
         "model": "deepseek-chat",
         "messages": messages,
         "stream": True,
-        "max_tokens": min(2000, MAX_TOKENS - count_tokens(str(messages)))
+        "max_tokens": min(2000, MAX_TOKENS - tokens_used)
     }
     
     try:
-        with requests.post(api_url, headers=headers, json=data, stream=True) as response:
+        with SESSION.post(api_url, headers=headers, data=orjson.dumps(data), stream=True) as response:
             if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith("data:"):
-                            json_data = decoded_line[5:].strip()
-                            if json_data != "[DONE]":
-                                try:
-                                    chunk = json.loads(json_data)
-                                    if "choices" in chunk and chunk["choices"]:
-                                        content = chunk["choices"][0].get("delta", {}).get("content", "")
-                                        if content:
-                                            yield content
-                                except json.JSONDecodeError:
-                                    pass
+                for payload in iter_sse_data(response):
+                    if payload != b"[DONE]":
+                        try:
+                            chunk = orjson.loads(payload)
+                            if "choices" in chunk and chunk["choices"]:
+                                content = chunk["choices"][0].get("delta", {}).get("content", "")
+                                if content:
+                                    yield content
+                        except orjson.JSONDecodeError:
+                            pass
             else:
                 yield f"[API 错误] 状态码: {response.status_code}"
     except Exception as e:
         yield f"[连接错误] {str(e)}"
 
-def respond(message: str, chat_history: List[Tuple[str, str]], profile: dict, current_file: str):
+def respond(message: str, chat_history: List[Tuple[str, str]], current_file: str, system_prompt: str, system_prompt_tokens: int):
     if not message.strip():
         yield chat_history, current_file
         return
@@ -225,13 +372,16 @@ def respond(message: str, chat_history: List[Tuple[str, str]], profile: dict, cu
         trimmed_history = trim_conversation(cleaned_history, MAX_TOKENS // 2)
         
         bot_message = ""
-        for chunk in call_deepseek_api_stream(message, trimmed_history, profile):
+        # 预先分配展示列表，流式输出时只更新最后一项
+        streamed_history = trimmed_history + [(message, bot_message)]
+        for chunk in call_deepseek_api_stream(message, trimmed_history, system_prompt, system_prompt_tokens):
             bot_message += chunk
-            temp_history = trimmed_history + [(message, bot_message)]
-            yield temp_history, current_file
+            streamed_history[-1] = (message, bot_message)
+            yield streamed_history, current_file
         
-        full_conversation = trimmed_history + [(message, bot_message)]
-        current_file = save_conversation(full_conversation, current_file)
+        full_conversation = streamed_history
+        # 历史记录已在磁盘上，只追加本轮新对话
+        current_file = append_turn(message, bot_message, current_file)
         yield full_conversation, current_file
     except Exception as e:
         print(f"对话出错: {str(e)}")
@@ -245,6 +395,14 @@ def create_interface(profile: dict):
         initial_history = load_recent_conversations()
         current_file = gr.State("")
         
+        # 配置在会话期间不变，系统提示词及其token数只计算一次
+        system_prompt = build_system_prompt(profile)
+        chat_respond = partial(
+            respond,
+            system_prompt=system_prompt,
+            system_prompt_tokens=count_tokens(system_prompt)
+        )
+        
         with gr.Row():
             with gr.Column(scale=1):
                 gr.Markdown("### 用户资料")
@@ -277,17 +435,11 @@ def create_interface(profile: dict):
             submit_btn = gr.Button("发送", variant="primary", scale=1)
             clear = gr.Button("清空", scale=1)
         
-        msg.submit(
-            respond,
-            [msg, chatbot, gr.State(profile), current_file],
-            [chatbot, current_file]
-        ).then(
-            lambda: "", None, msg
-        )
-        
-        submit_btn.click(
-            respond,
-            [msg, chatbot, gr.State(profile), current_file],
+        # 回车和发送按钮共用同一个事件处理
+        gr.on(
+            [msg.submit, submit_btn.click],
+            chat_respond,
+            [msg, chatbot, current_file],
             [chatbot, current_file]
         ).then(
             lambda: "", None, msg